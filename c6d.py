@@ -13,14 +13,20 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import atexit
+import collections
 import ctypes
-import re, select, socket, sys
+import hashlib
+import json
+import os, re, select, socket, struct, sys
+import Queue
 import threading
 import time
 import pybonjour
 
 DEBUG = False
 DLLs = ['libgphoto2.so.6', 'libgphoto2.6.dylib']
+INDEX_DIR = os.path.join(os.path.expanduser('~'), '.6dpy')
 
 GP_CAPTURE_IMAGE            = 0
 GP_CAPTURE_MOVIE            = 1
@@ -32,6 +38,13 @@ GP_EVENT_FILE_ADDED         = 2
 GP_EVENT_FOLDER_ADDED       = 3
 GP_EVENT_CAPTURE_COMPLETE   = 4
 
+GP_FILE_TYPE_NORMAL         = 1
+
+LOG_DEBUG                   = 10
+LOG_INFO                    = 20
+LOG_WARNING                 = 30
+LOG_ERROR                   = 40
+
 gphoto = None
 for dll in DLLs:
     if not gphoto:
@@ -42,6 +55,9 @@ for dll in DLLs:
 
 if not gphoto:
     raise Exception('could not locate gphoto2 dynamic library')
+
+# needed to release event data allocated by libgphoto2
+libc = ctypes.CDLL(None)
     
 gphoto.gp_context_new.restype = ctypes.c_void_p
 gphoto.gp_camera_init.argtypes = [ ctypes.c_void_p, ctypes.c_void_p ]
@@ -58,6 +74,26 @@ class CameraAbilities(ctypes.Structure):
 class CameraFilePath(ctypes.Structure):
     _fields_ = [('name', (ctypes.c_char * 128)), ('folder', (ctypes.c_char * 1024))]
 
+class CameraFileInfoPreview(ctypes.Structure):
+    _fields_ = [('fields', ctypes.c_int), ('status', ctypes.c_int),
+                ('size', ctypes.c_uint64), ('type', (ctypes.c_char * 64)),
+                ('width', ctypes.c_uint), ('height', ctypes.c_uint)]
+
+class CameraFileInfoFile(ctypes.Structure):
+    _fields_ = [('fields', ctypes.c_int), ('status', ctypes.c_int),
+                ('size', ctypes.c_uint64), ('type', (ctypes.c_char * 64)),
+                ('width', ctypes.c_uint), ('height', ctypes.c_uint),
+                ('permissions', ctypes.c_int), ('mtime', ctypes.c_long)]
+
+class CameraFileInfoAudio(ctypes.Structure):
+    _fields_ = [('fields', ctypes.c_int), ('status', ctypes.c_int),
+                ('size', ctypes.c_uint64), ('type', (ctypes.c_char * 64))]
+
+class CameraFileInfo(ctypes.Structure):
+    _fields_ = [('preview', CameraFileInfoPreview),
+                ('file', CameraFileInfoFile),
+                ('audio', CameraFileInfoAudio)]
+
 class GPhotoError(Exception):
     def __init__(self, result, message):
         self.result = result
@@ -65,11 +101,234 @@ class GPhotoError(Exception):
     def __str__(self):
         return self.message + ' (' + str(self.result) + ')'
 
+class ConfigSnapshot(object):
+    """Immutable, hashable snapshot of a camera configuration.
+
+    Values are the tuples returned by PTPIPCamera.get_config, keyed by
+    widget name.  Read-only widgets are recorded so they are never
+    written back when the snapshot is restored.
+    """
+    __slots__ = ('_items', '_index', '_readonly')
+
+    def __init__(self, values, readonly=()):
+        if isinstance(values, dict):
+            values = values.items()
+        self._items = tuple(sorted((str(k), tuple(v)) for (k, v) in values if v))
+        self._index = dict(self._items)
+        self._readonly = frozenset(readonly)
+
+    def keys(self):
+        return [k for (k, v) in self._items]
+
+    def items(self):
+        return list(self._items)
+
+    def get(self, label, default=None):
+        return self._index.get(label, default)
+
+    def is_readonly(self, label):
+        return label in self._readonly
+
+    def __getitem__(self, label):
+        return self._index[label]
+
+    def __contains__(self, label):
+        return label in self._index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._items)
+
+    def __eq__(self, other):
+        return (isinstance(other, ConfigSnapshot) and
+                self._items == other._items and
+                self._readonly == other._readonly)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self._items, self._readonly))
+
+    def __repr__(self):
+        return 'ConfigSnapshot(%d values)' % len(self._items)
+
+    # camera strings are raw bytes which need not be valid UTF-8; latin-1
+    # maps every byte to one code point so any value survives the round-trip
+    json_encoding = 'latin-1'
+
+    def to_json(self):
+        def text(v):
+            if isinstance(v, str):
+                return v.decode(self.json_encoding)
+            return v
+        values = dict((text(k), [text(x) for x in v]) for (k, v) in self._items)
+        return json.dumps({ 'values': values,
+                            'readonly': [text(k) for k in sorted(self._readonly)],
+                            'encoding': self.json_encoding },
+                          sort_keys=True)
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        encoding = data.get('encoding', cls.json_encoding)
+        def raw(v):
+            # json yields unicode strings; gphoto wants byte strings
+            if isinstance(v, unicode):
+                return v.encode(encoding)
+            return v
+        values = [(raw(k), [raw(x) for x in v]) for (k, v) in data['values'].items()]
+        readonly = [raw(k) for k in data.get('readonly', [])]
+        return cls(values, readonly)
+
+class QueuedLogger:
+    """Logger which hands records to a background writer thread.
+
+    Records below the current level are dropped before any formatting
+    takes place.  Accepted records are also kept in a fixed size ring
+    buffer which can be dumped after a crash.  The writer queue is bounded;
+    when it is full records are dropped from the output (but not from the
+    ring buffer) and the number dropped is reported.
+    """
+    level_names = { LOG_DEBUG: 'DEBUG',
+                    LOG_INFO: 'INFO',
+                    LOG_WARNING: 'WARNING',
+                    LOG_ERROR: 'ERROR' }
+
+    def __init__(self, level=LOG_INFO, stream=None, ring_size=1024, queue_size=4096):
+        self.level = level
+        self.stream = stream or sys.stdout
+        self.ring = collections.deque(maxlen=ring_size)
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def set_thread_context(self, context):
+        # context attached to records from native callbacks on this thread
+        self.local.context = context
+
+    def thread_context(self):
+        return getattr(self.local, 'context', None)
+
+    def log(self, level, label, context, msg, args=()):
+        if level < self.level:
+            return
+        record = (time.time(), level, label, context, msg, args)
+        self.ring.append(record)
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+        if not self.thread:
+            self._start()
+
+    def format(self, record):
+        (when, level, label, context, msg, args) = record
+        if args:
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                msg = '%s %r' % (msg, args)
+        stamp = time.strftime('%H:%M:%S', time.localtime(when))
+        stamp += '.%03d' % int((when % 1) * 1000)
+        name = self.level_names.get(level, str(level))
+        if context:
+            label = '%s [%s]' % (label, context)
+        return '%s %-7s %s %s' % (stamp, name, label, msg)
+
+    def _start(self):
+        with self.lock:
+            if not self.thread:
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self.thread = thread
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    break
+                self.stream.write(self.format(record) + '\n')
+                with self.lock:
+                    (dropped, self.dropped) = (self.dropped, 0)
+                if dropped:
+                    self.stream.write('%d log records dropped\n' % dropped)
+                if self.queue.empty():
+                    self.stream.flush()
+            except Exception:
+                pass
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        if self.thread:
+            self.queue.join()
+
+    def close(self):
+        # stop the writer once everything queued has been written
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread:
+            self.queue.put(None)
+            thread.join()
+
+    def dump(self, stream=None):
+        # write out the most recent records, e.g. after a crash
+        stream = stream or sys.stderr
+        for record in list(self.ring):
+            stream.write(self.format(record) + '\n')
+        stream.flush()
+
+    def crash_dump(self, stream=None):
+        # flush pending output first so the dump follows it
+        self.flush()
+        self.dump(stream)
+
+if DEBUG:
+    LOGGER = QueuedLogger(level=LOG_DEBUG)
+else:
+    LOGGER = QueuedLogger(level=LOG_INFO)
+atexit.register(LOGGER.close)
+
+def install_excepthook():
+    # dump the log ring buffer on unhandled exceptions in the main thread
+    previous = sys.excepthook
+    if getattr(previous, 'crash_dump', False):
+        return
+    def excepthook(exc_type, exc_value, exc_traceback):
+        LOGGER.log(LOG_ERROR, 'main', None, 'unhandled %s - %s',
+                   (exc_type.__name__, str(exc_value)))
+        LOGGER.crash_dump()
+        previous(exc_type, exc_value, exc_traceback)
+    excepthook.crash_dump = True
+    sys.excepthook = excepthook
+
+# map libgphoto2 GPLogLevel to our levels
+gphoto_log_levels = { 0: LOG_ERROR,
+                      1: LOG_INFO,
+                      2: LOG_DEBUG,
+                      3: LOG_DEBUG }
+
 def gphoto_debug(level, domain, msg, data):
-    print domain, msg
+    # strings are only converted once the record is known to be wanted
+    level = gphoto_log_levels.get(level, LOG_DEBUG)
+    if level >= LOGGER.level:
+        LOGGER.log(level, 'gphoto2', LOGGER.thread_context(), '%s %s',
+                   (ctypes.string_at(domain), ctypes.string_at(msg)))
     return 0
 
-GPhotoLogFunc = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p)
+GPhotoLogFunc = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p)
 GPhotoDebug = GPhotoLogFunc(gphoto_debug)
 if DEBUG:
     gphoto.gp_log_add_func(2, GPhotoDebug, 0)
@@ -80,20 +339,99 @@ def gphoto_check(result):
         raise GPhotoError(result, message)
     return result
 
+class NativeHandle(object):
+    """Owning reference to an object allocated by libgphoto2.
+
+    The pointer is released exactly once, by release(), on leaving a with
+    block or when the handle is garbage collected.  Outstanding handles
+    are counted per kind, see outstanding().
+    Handles can be passed directly to gphoto functions.
+    """
+    lock = threading.RLock()
+    counts = {}
+
+    def __init__(self, kind, release_func):
+        self.kind = kind
+        self.release_func = release_func
+        self.ptr = ctypes.c_void_p()
+        self.owned = False
+
+    @property
+    def _as_parameter_(self):
+        return self.ptr
+
+    def __nonzero__(self):
+        return bool(self.ptr.value)
+
+    def ref(self):
+        # pointer for an allocating call; follow a successful call with own()
+        self.release()
+        return ctypes.pointer(self.ptr)
+
+    def own(self):
+        if self.ptr.value and not self.owned:
+            with self.lock:
+                self.owned = True
+                self.counts[self.kind] = self.counts.get(self.kind, 0) + 1
+        return self
+
+    def release(self):
+        with self.lock:
+            if not self.owned:
+                return
+            self.owned = False
+            self.counts[self.kind] -= 1
+            ptr = self.ptr
+            self.ptr = ctypes.c_void_p()
+        self.release_func(ptr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
+
+    @classmethod
+    def outstanding(cls):
+        # kind -> number of handles not yet released
+        with cls.lock:
+            return dict((kind, count)
+                        for (kind, count) in cls.counts.items() if count)
+
 class Common:
     log_label = 'Common'
+    log_context = None
+
+    def log(self, msg, *args, **kwargs):
+        level = kwargs.get('level', LOG_INFO)
+        if kwargs.get('debug'):
+            level = LOG_DEBUG
+        if level >= LOGGER.level:
+            LOGGER.log(level, self.log_label, self.log_context, msg, args)
 
-    def log(self, msg, debug=False):
-        if (debug and DEBUG) or (not debug):
-            print self.log_label, msg
+    def debug(self, msg, *args):
+        self.log(msg, *args, level=LOG_DEBUG)
 
-    def debug(self, msg):
-        self.log(msg, debug=True)
+    def error(self, msg, *args):
+        self.log(msg, *args, level=LOG_ERROR)
     
     def start(self):
         def run():
+            LOGGER.set_thread_context(self.log_context)
             self.log('started thread')
-            self.run()
+            try:
+                self.run()
+            except:
+                self.error('thread crashed')
+                LOGGER.crash_dump()
+                raise
             self.log('finished thread')
         self.log('starting thread')
         self.thread = threading.Thread(target=run)
@@ -118,13 +456,16 @@ class PTPIPCamera(Common):
         self.context = ctypes.c_void_p() #gphoto.gp_context_new()
         self.target = target
         self.guid = guid
-        self.handle = ctypes.c_void_p()
+        self.log_context = guid
+        self.handle = NativeHandle('camera', gphoto.gp_camera_unref)
         self.portlist = None
         self.abilitylist = None
         self.connected = False
         self.cached_root = None
         self.cached_time = 0
         self.cache_expiry = 2 # seconds
+        self.file_index = None
+        self.ingest = None
 
     def encoded_path(self):
         return "ptpip:" + self.target
@@ -148,8 +489,9 @@ class PTPIPCamera(Common):
     def connect(self):
         # allocate and initialise a new camera
         self.debug('allocate camera')
-        res = gphoto.gp_camera_new(ctypes.pointer(self.handle))
+        res = gphoto.gp_camera_new(self.handle.ref())
         gphoto_check(res)
+        self.handle.own()
       
         # set model and guid in settings file
         gphoto.gp_setting_set("gphoto2", "model", "PTP/IP Camera")
@@ -158,16 +500,18 @@ class PTPIPCamera(Common):
         # load abilities
         if not self.abilitylist:
             self.debug('load abilities list')
-            self.abilitylist = ctypes.c_void_p()
-            gphoto.gp_abilities_list_new(ctypes.pointer(self.abilitylist))
-            res = gphoto.gp_abilities_list_load(self.abilitylist)
+            self.abilitylist = NativeHandle('abilities list', gphoto.gp_abilities_list_free)
+            res = gphoto.gp_abilities_list_new(self.abilitylist.ref())
+            gphoto_check(res)
+            self.abilitylist.own()
+            res = gphoto.gp_abilities_list_load(self.abilitylist, self.context)
             gphoto_check(res)
         
         # search for model abilities
         self.debug('search abilities list')
         index = gphoto.gp_abilities_list_lookup_model(self.abilitylist, 'PTP/IP Camera')
         gphoto_check(index)
-        self.debug('found at %d' % index)
+        self.debug('found at %d', index)
         
         # load abilities
         self.debug('load abilities')
@@ -183,8 +527,10 @@ class PTPIPCamera(Common):
         # load port list
         if not self.portlist:
             self.debug('load port list')
-            self.portlist = ctypes.c_void_p()
-            gphoto.gp_port_info_list_new(ctypes.pointer(self.portlist))
+            self.portlist = NativeHandle('port list', gphoto.gp_port_info_list_free)
+            res = gphoto.gp_port_info_list_new(self.portlist.ref())
+            gphoto_check(res)
+            self.portlist.own()
             res = gphoto.gp_port_info_list_load(self.portlist)
             gphoto_check(res)
 
@@ -192,7 +538,7 @@ class PTPIPCamera(Common):
         self.debug('search for port info')
         index = gphoto.gp_port_info_list_lookup_path(self.portlist, self.encoded_path())
         gphoto_check(index)
-        self.debug('found at %d' % index)
+        self.debug('found at %d', index)
 
         # load port info entry
         self.debug('load port info')
@@ -206,7 +552,7 @@ class PTPIPCamera(Common):
         gphoto_check(res)
         
         # load the port path for debugging
-        if DEBUG:
+        if LOGGER.enabled(LOG_DEBUG):
             path = ctypes.c_char_p()
             res = gphoto.gp_port_info_get_path(info, ctypes.pointer(path))
             gphoto_check(res)
@@ -223,31 +569,55 @@ class PTPIPCamera(Common):
 
     def disconnect(self):
         self._clear_cache()
-        res = gphoto.gp_camera_exit(self.handle, self.context)
-        gphoto_check(res)
-        res = gphoto.gp_camera_unref(self.handle)
-        gphoto_check(res)
-        res = gphoto.gp_context_unref(self.context)
-        gphoto_check(res)
+        try:
+            if self.handle:
+                res = gphoto.gp_camera_exit(self.handle, self.context)
+                gphoto_check(res)
+        finally:
+            # release native resources even if the camera did not exit cleanly
+            self.connected = False
+            self.handle.release()
+            for handle in (self.abilitylist, self.portlist):
+                if handle:
+                    handle.release()
+            self.abilitylist = None
+            self.portlist = None
+            self.debug('outstanding native handles %r', NativeHandle.outstanding())
         # FIXME: gphoto PTP/IP does not close sockets properly; try to work around?
 
     def _root_widget(self):
         now = time.time()
         if (not self.cached_root) or abs(now - self.cached_time) > self.cache_expiry:
-            if not self.cached_root:
-                gphoto.gp_widget_free(self.cached_root)
-                self.cached_root = None
-            root = ctypes.c_void_p()
-            res = gphoto.gp_camera_get_config(self.handle, ctypes.pointer(root), self.context)
+            self._clear_cache()
+            root = NativeHandle('widget tree', gphoto.gp_widget_free)
+            res = gphoto.gp_camera_get_config(self.handle, root.ref(), self.context)
             if res >= 0:
-                self.cached_root = root
+                self.cached_root = root.own()
                 self.cached_time = now
         return self.cached_root
 
     def _clear_cache(self):
         if self.cached_root:
-            gphoto.gp_widget_free(self.cached_root)
-            self.cached_root = None
+            self.cached_root.release()
+        self.cached_root = None
+
+    def _walk_widgets(self, root):
+        # yield (name, widget) for every leaf widget below root
+        stack = [root]
+        while stack:
+            widget = stack.pop()
+            count = gphoto.gp_widget_count_children(widget)
+            if count > 0:
+                for i in range(count):
+                    child = ctypes.c_void_p()
+                    res = gphoto.gp_widget_get_child(widget, i, ctypes.pointer(child))
+                    gphoto_check(res)
+                    stack.append(child)
+            else:
+                name = ctypes.c_char_p()
+                res = gphoto.gp_widget_get_name(widget, ctypes.pointer(name))
+                gphoto_check(res)
+                yield (name.value, widget)
 
     def _find_widget(self, label):
         root = self._root_widget()
@@ -279,6 +649,13 @@ class PTPIPCamera(Common):
         else:
             return 'unknown'
 
+    def _widget_readonly(self, pair):
+        (root, child) = pair
+        readonly = ctypes.c_int()
+        res = gphoto.gp_widget_get_readonly(child, ctypes.pointer(readonly))
+        gphoto_check(res)
+        return (readonly.value != 0)
+
     def _widget_value(self, pair):
         (root, child) = pair
         w_type = self._widget_type(pair)
@@ -429,7 +806,7 @@ class PTPIPCamera(Common):
         'whitebalanceadjustb',
         'whitebalancexa',
         'whitebalancexb',
-        'colorspace'
+        'colorspace',
         'exposurecompensation',
         'focusmode',
         'autoexposuremode',
@@ -440,11 +817,70 @@ class PTPIPCamera(Common):
         'aperture',
         'capturetarget' ]
 
+    # widgets which trigger camera actions or change its operating state;
+    # these are never written back by restore_config
+    action_widgets = [
+        'uilock',
+        'bulb',
+        'autofocusdrive',
+        'manualfocusdrive',
+        'eoszoom',
+        'eoszoomposition',
+        'eosviewfinder',
+        'eosremoterelease',
+        'output',
+        'evfmode',
+        'capture' ]
+
+    def _widget_restorable(self, pair, name):
+        # only shooting settings from known_widgets are restored
+        if (name not in self.known_widgets) or (name in self.action_widgets):
+            return False
+        if self._widget_type(pair) in ('date', 'button'):
+            return False
+        return not self._widget_readonly(pair)
+
     def list_config(self):
-        config = {}
-        for k in self.known_widgets:
-            config[k] = self.get_config(k)
-        return config
+        root = self._root_widget()
+        values = []
+        readonly = []
+        if root:
+            for (name, child) in self._walk_widgets(root):
+                pair = (root, child)
+                value = self._widget_value(pair)
+                if value:
+                    values.append((name, value))
+                    if self._widget_readonly(pair):
+                        readonly.append(name)
+        return ConfigSnapshot(values, readonly)
+
+    def restore_config(self, snapshot):
+        # apply only the restorable values which differ from the cached tree,
+        # then commit them to the camera in a single set_config call
+        root = self._root_widget()
+        if not root:
+            return None
+        changed = []
+        for (name, child) in self._walk_widgets(root):
+            if (name not in snapshot) or snapshot.is_readonly(name):
+                continue
+            pair = (root, child)
+            if not self._widget_restorable(pair, name):
+                continue
+            wanted = snapshot[name]
+            current = self._widget_value(pair)
+            if (not current) or (current[0] != wanted[0]) or (current[1] == wanted[1]):
+                continue
+            if self._widget_set(pair, wanted[1]):
+                changed.append(name)
+            else:
+                self.log('unable to restore %s to %s', name, str(wanted[1]))
+        if changed:
+            res = gphoto.gp_camera_set_config(self.handle, root, self.context)
+            if res < 0:
+                self._clear_cache()
+                return None
+        return changed
 
     # XXX: this hangs waiting for response from camera
     def trigger_capture(self):
@@ -453,7 +889,7 @@ class PTPIPCamera(Common):
             gphoto_check(res)
             return True
         except GPhotoError as e:
-            self.log(str(e))
+            self.error(str(e))
             return False
 
     # XXX: this hangs waiting for response from camera
@@ -464,22 +900,496 @@ class PTPIPCamera(Common):
             gphoto_check(res)
             return (path.folder, path.name)
         except GPhotoError as e:
-            self.log(str(e))
+            self.error(str(e))
             return None
 
     def wait_for_event(self, timeout=10):
         ev_type = ctypes.c_int()
-        data = ctypes.c_void_p()
-        res = gphoto.gp_camera_capture(self.handle, 
-                ctypes.c_int(timeout),
-                ctypes.pointer(ev_type),
-                ctypes.pointer(data), self.context)
-        try:
+        with NativeHandle('event data', libc.free) as data:
+            res = gphoto.gp_camera_wait_for_event(self.handle, 
+                    ctypes.c_int(timeout),
+                    ctypes.pointer(ev_type),
+                    data.ref(), self.context)
+            data.own()
+            try:
+                gphoto_check(res)
+            except GPhotoError as e:
+                self.error(str(e))
+                return None
+            if (ev_type.value == GP_EVENT_FILE_ADDED) and data:
+                path = ctypes.cast(data.ptr, ctypes.POINTER(CameraFilePath)).contents
+                if self.file_index is not None:
+                    try:
+                        self.file_index.file_added(self, path.folder, path.name)
+                    except GPhotoError as e:
+                        self.error(str(e))
+        return ev_type.value
+
+    def _list_names(self, list_func, folder):
+        names = []
+        with NativeHandle('list', gphoto.gp_list_free) as lst:
+            res = gphoto.gp_list_new(lst.ref())
+            gphoto_check(res)
+            lst.own()
+            res = list_func(self.handle, ctypes.c_char_p(folder), lst, self.context)
+            gphoto_check(res)
+            count = gphoto_check(gphoto.gp_list_count(lst))
+            for i in range(count):
+                ptr = ctypes.c_char_p()
+                res = gphoto.gp_list_get_name(lst, i, ctypes.pointer(ptr))
+                gphoto_check(res)
+                names.append(ptr.value)
+        return names
+
+    def list_folders(self, folder):
+        return self._list_names(gphoto.gp_camera_folder_list_folders, folder)
+
+    def list_files(self, folder):
+        return self._list_names(gphoto.gp_camera_folder_list_files, folder)
+
+    def file_info(self, folder, name):
+        info = CameraFileInfo()
+        res = gphoto.gp_camera_file_get_info(self.handle,
+                ctypes.c_char_p(folder), ctypes.c_char_p(name),
+                ctypes.pointer(info), self.context)
+        gphoto_check(res)
+        return (info.file.size, info.file.mtime)
+
+    def file_data(self, folder, name):
+        with NativeHandle('file', gphoto.gp_file_unref) as camera_file:
+            res = gphoto.gp_file_new(camera_file.ref())
+            gphoto_check(res)
+            camera_file.own()
+            res = gphoto.gp_camera_file_get(self.handle,
+                    ctypes.c_char_p(folder), ctypes.c_char_p(name),
+                    ctypes.c_int(GP_FILE_TYPE_NORMAL), camera_file, self.context)
             gphoto_check(res)
-            return ev_type.value
+            ptr = ctypes.c_void_p()
+            size = ctypes.c_ulong()
+            res = gphoto.gp_file_get_data_and_size(camera_file, ctypes.pointer(ptr), ctypes.pointer(size))
+            gphoto_check(res)
+            return ctypes.string_at(ptr, size.value)
+
+    def download(self, folder, name):
+        # file contents are kept in memory and handed to the ingest
+        # pipeline so the camera thread never waits on the disk
+        try:
+            data = self.file_data(folder, name)
         except GPhotoError as e:
-            self.log(str(e))
+            self.error(str(e))
             return None
+        if self.ingest is not None:
+            # only mark the file downloaded once the pipeline has written it
+            written = None
+            if self.file_index is not None:
+                written = self.file_index.mark_downloaded
+            self.ingest.submit(folder, name, data, written)
+        elif self.file_index is not None:
+            self.file_index.mark_downloaded(folder, name)
+        return data
+
+    def download_new(self):
+        count = 0
+        if self.file_index is not None:
+            for (folder, name, size, mtime) in self.file_index.not_downloaded():
+                if self.download(folder, name) is not None:
+                    count += 1
+        return count
+
+    def dcim_folders(self):
+        # returns the image folders of each storage, oldest first
+        folders = []
+        for storage in self.list_folders('/'):
+            base = '/' + storage
+            if 'DCIM' in self.list_folders(base):
+                dcim = base + '/DCIM'
+                folders.append([dcim + '/' + f for f in sorted(self.list_folders(dcim))])
+        return folders
+
+class CameraFileIndex(Common):
+    """Persistent index of the files stored on a camera's cards.
+
+    Entries map (folder, name) to [size, mtime, downloaded].  The index is
+    built by a full walk of the DCIM folders once, then kept current from
+    FILE_ADDED events and by re-listing only the folders from the newest
+    indexed one onwards on each storage, so queries never need to touch
+    the camera.  Entries in folders which have disappeared are dropped.
+    Until a full walk has completed every sync walks again.
+    """
+    log_label = 'CameraFileIndex'
+
+    def __init__(self, guid, path=None):
+        self.guid = guid
+        self.log_context = guid
+        if path:
+            self.path = path
+        else:
+            self.path = os.path.join(INDEX_DIR, 'index-%s.json' % guid)
+        self.files = {}
+        self.complete = False
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        with self.lock:
+            self.files = {}
+            for (folder, name, size, mtime, downloaded) in data['files']:
+                self.files[(str(folder), str(name))] = [size, mtime, downloaded]
+            self.complete = data.get('complete', False)
+            self.dirty = False
+        self.debug('loaded %d entries from %s', len(self.files), self.path)
+        return True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = [[folder, name] + entry
+                        for ((folder, name), entry) in sorted(self.files.items())]
+            complete = self.complete
+            self.dirty = False
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({ 'guid': self.guid,
+                        'complete': complete,
+                        'files': entries }, f)
+        os.rename(tmp, self.path)
+        self.debug('saved %d entries to %s', len(entries), self.path)
+
+    def add(self, folder, name, size, mtime):
+        with self.lock:
+            entry = self.files.get((folder, name))
+            if entry and (entry[0] == size) and (entry[1] == mtime):
+                return False
+            self.files[(folder, name)] = [size, mtime, False]
+            self.dirty = True
+        return True
+
+    def remove(self, folder, name):
+        with self.lock:
+            if (folder, name) in self.files:
+                del self.files[(folder, name)]
+                self.dirty = True
+
+    def mark_downloaded(self, folder, name, downloaded=True):
+        with self.lock:
+            entry = self.files.get((folder, name))
+            if entry and (entry[2] != downloaded):
+                entry[2] = downloaded
+                self.dirty = True
+
+    def _select(self, predicate):
+        with self.lock:
+            result = [(folder, name, size, mtime)
+                        for ((folder, name), (size, mtime, downloaded)) in self.files.items()
+                        if predicate(size, mtime, downloaded)]
+        return sorted(result, key=lambda e: (e[3], e[0], e[1]))
+
+    def files_since(self, mtime):
+        return self._select(lambda s, m, d: m > mtime)
+
+    def not_downloaded(self):
+        return self._select(lambda s, m, d: not d)
+
+    def file_added(self, camera, folder, name):
+        (size, mtime) = camera.file_info(folder, name)
+        self.add(folder, name, size, mtime)
+
+    def _scan_folder(self, camera, folder):
+        # known names are re-checked too: after a format or card change
+        # the same name may refer to a different file
+        names = camera.list_files(folder)
+        with self.lock:
+            known = set(n for (f, n) in self.files if f == folder)
+        added = 0
+        for name in names:
+            (size, mtime) = camera.file_info(folder, name)
+            if self.add(folder, name, size, mtime):
+                added += 1
+        for name in known.difference(names):
+            self.remove(folder, name)
+        return added
+
+    def _prune(self, dcim_folders):
+        # drop entries for folders which no longer exist on any storage
+        present = set(f for folders in dcim_folders for f in folders)
+        with self.lock:
+            missing = [key for key in self.files if key[0] not in present]
+            for key in missing:
+                del self.files[key]
+            if missing:
+                self.dirty = True
+        return len(missing)
+
+    def build(self, camera):
+        added = 0
+        dcim_folders = camera.dcim_folders()
+        self._prune(dcim_folders)
+        for folders in dcim_folders:
+            for folder in folders:
+                added += self._scan_folder(camera, folder)
+        with self.lock:
+            self.complete = True
+            self.dirty = True
+        self.log('indexed %d files', added)
+
+    def refresh(self, camera):
+        # re-list the newest indexed folder and any created after it, in
+        # case the camera moved on to a new folder while disconnected
+        with self.lock:
+            indexed = set(f for (f, n) in self.files)
+        added = 0
+        dcim_folders = camera.dcim_folders()
+        removed = self._prune(dcim_folders)
+        if removed:
+            self.log('removed %d files from missing folders', removed)
+        for folders in dcim_folders:
+            start = 0
+            for (i, folder) in enumerate(folders):
+                if folder in indexed:
+                    start = i
+            for folder in folders[start:]:
+                added += self._scan_folder(camera, folder)
+        self.log('found %d new or changed files', added)
+
+    def sync(self, camera):
+        if self.complete:
+            self.refresh(camera)
+        else:
+            self.build(camera)
+        self.save()
+
+def _exif_rational(data, endian, offset):
+    (num, den) = struct.unpack_from(endian + 'II', data, offset)
+    if den == 0:
+        return None
+    return float(num) / den
+
+def _exif_tiff(data, base):
+    # extract exposure settings from a TIFF structure at base
+    if data[base:base + 2] == 'II':
+        endian = '<'
+    elif data[base:base + 2] == 'MM':
+        endian = '>'
+    else:
+        return {}
+
+    def entries(ifd):
+        count = struct.unpack_from(endian + 'H', data, base + ifd)[0]
+        for i in range(count):
+            entry = base + ifd + 2 + (i * 12)
+            (tag, e_type, e_count, value) = struct.unpack_from(endian + 'HHII', data, entry)
+            yield (tag, e_type, entry + 8, value)
+
+    exif_ifd = None
+    ifd0 = struct.unpack_from(endian + 'I', data, base + 4)[0]
+    for (tag, e_type, pos, value) in entries(ifd0):
+        if tag == 0x8769:
+            exif_ifd = value
+    if exif_ifd is None:
+        return {}
+
+    exif = {}
+    for (tag, e_type, pos, value) in entries(exif_ifd):
+        if tag == 0x829d:
+            fnumber = _exif_rational(data, endian, base + value)
+            if fnumber:
+                exif['aperture'] = '%.1f' % fnumber
+        elif tag == 0x829a:
+            exposure = _exif_rational(data, endian, base + value)
+            if exposure:
+                if exposure < 1.0:
+                    exif['shutterspeed'] = '1/%d' % int(round(1.0 / exposure))
+                else:
+                    exif['shutterspeed'] = '%g' % exposure
+        elif tag == 0x8827:
+            exif['iso'] = str(struct.unpack_from(endian + 'H', data, pos)[0])
+    return exif
+
+def read_exif(data):
+    """Return aperture, shutterspeed and iso from a JPEG or CR2 image.
+
+    Values are formatted like the matching camera config choices; missing
+    or unparsable tags are simply left out.
+    """
+    try:
+        if data[:4] in ('II*\x00', 'MM\x00*'):
+            return _exif_tiff(data, 0)
+        if data[:2] != '\xff\xd8':
+            return {}
+        pos = 2
+        while pos + 4 <= len(data) and data[pos] == '\xff':
+            (marker, length) = struct.unpack_from('>BH', data, pos + 1)
+            if marker == 0xe1 and data[pos + 4:pos + 10] == 'Exif\x00\x00':
+                return _exif_tiff(data, pos + 10)
+            if marker == 0xda:
+                break
+            pos += 2 + length
+    except (struct.error, IndexError):
+        pass
+    return {}
+
+class IngestPipeline(Common):
+    """Post-download processing of camera files on a pool of threads.
+
+    Each file is hashed, its exposure settings are read from the EXIF
+    data, it is written out under a sequence number and a JSON sidecar is
+    stored next to it, before any registered hooks are run.  The work
+    queue is bounded: submit blocks once it is full, which throttles the
+    downloader rather than letting files pile up in memory.
+    """
+    log_label = 'IngestPipeline'
+    stages = ['hash', 'exif', 'write', 'sidecar', 'hooks']
+
+    def __init__(self, directory, workers=2, queue_size=4, prefix='IMG_'):
+        self.directory = directory
+        self.workers = workers
+        self.prefix = prefix
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.hooks = []
+        self.threads = []
+        self.lock = threading.Lock()
+        self.counters = dict((stage, [0, 0, 0.0]) for stage in self.stages)
+        self.sequence = self._last_sequence()
+        self._shutdown = False
+
+    def _last_sequence(self):
+        last = 0
+        if os.path.isdir(self.directory):
+            pattern = re.compile(re.escape(self.prefix) + r'(\d+)\.')
+            for name in os.listdir(self.directory):
+                m = pattern.match(name)
+                if m:
+                    last = max(last, int(m.group(1)))
+        return last
+
+    def add_hook(self, hook):
+        # hook(record) is called on a worker thread for every ingested file
+        self.hooks.append(hook)
+
+    def submit(self, folder, name, data, written=None):
+        # written(folder, name) is called once the file is safely on disk
+        if self._shutdown:
+            return False
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+        self.queue.put((folder, name, sequence, data, written))
+        return True
+
+    def _timed(self, stage, size, func, *args):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        with self.lock:
+            counter = self.counters[stage]
+            counter[0] += 1
+            counter[1] += size
+            counter[2] += elapsed
+        return result
+
+    def _write(self, path, data):
+        # write to a temporary name so a failure never leaves a partial file
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _sidecar(self, record):
+        self._write(record['path'] + '.json',
+                    json.dumps(record, indent=1, sort_keys=True))
+
+    def _run_hooks(self, record):
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                self.error('hook failed for %s - %s', record['path'], str(e))
+
+    def process(self, folder, name, sequence, data, written=None):
+        size = len(data)
+        ext = os.path.splitext(name)[1].lower()
+        path = os.path.join(self.directory, '%s%05d%s' % (self.prefix, sequence, ext))
+        record = { 'folder': folder,
+                   'name': name,
+                   'sequence': sequence,
+                   'size': size,
+                   'path': path }
+        record['sha1'] = self._timed('hash', size, lambda: hashlib.sha1(data).hexdigest())
+        record['exif'] = self._timed('exif', size, read_exif, data)
+        self._timed('write', size, self._write, path, data)
+        try:
+            self._timed('sidecar', size, self._sidecar, record)
+        except:
+            # without its metadata the file will be ingested again
+            os.remove(path)
+            raise
+        if written:
+            written(folder, name)
+        self._timed('hooks', size, self._run_hooks, record)
+        self.debug('ingested %s/%s as %s', folder, name, path)
+        return record
+
+    def run(self):
+        LOGGER.set_thread_context(self.log_context)
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                self.process(*item)
+            except Exception as e:
+                self.error('failed for %s/%s - %s', item[0], item[1], str(e))
+            finally:
+                self.queue.task_done()
+
+    def throughput(self):
+        # per-stage (files, bytes, seconds, bytes per second)
+        with self.lock:
+            result = {}
+            for (stage, (count, size, elapsed)) in self.counters.items():
+                rate = 0.0
+                if elapsed > 0:
+                    rate = size / elapsed
+                result[stage] = (count, size, elapsed, rate)
+        return result
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.log('starting %d workers', self.workers)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            if timeout:
+                thread.join(timeout=timeout)
+            else:
+                thread.join()
+        return not any(thread.isAlive() for thread in self.threads)
+
+    def shutdown(self):
+        # queued files are still processed before the workers exit
+        self.log('signalling shutdown')
+        self._shutdown = True
+        for thread in self.threads:
+            self.queue.put(None)
 
 class MDNSListener(Common):
     log_label = 'MDNSListener'
@@ -511,7 +1421,7 @@ class MDNSListener(Common):
                     fullname = hosttarget,
                     rrtype = pybonjour.kDNSServiceType_A,
                     callBack = callback)
-            self.log('query %s' % hosttarget)
+            self.log('query %s', hosttarget)
 
             try:
                 ready = select.select([query_sdRef], [], [], self.timeout)
@@ -537,7 +1447,7 @@ class MDNSListener(Common):
                 regtype,
                 replyDomain,
                 callback)
-        self.log('resolve %s' % serviceName)
+        self.log('resolve %s', serviceName)
 
         try:
             ready = select.select([resolve_sdRef], [], [], self.timeout)
@@ -555,8 +1465,7 @@ class MDNSListener(Common):
         self.browse_sdRef = pybonjour.DNSServiceBrowse(regtype = "_ptp._tcp", callBack = callback)
         try:
             while not self._shutdown:
-                if DEBUG:
-                    self.log('searching...')
+                self.debug('searching...')
                 ready = select.select([self.browse_sdRef], [], [], self.timeout)
                 if (not self._shutdown) and (self.browse_sdRef in ready[0]):
                     pybonjour.DNSServiceProcessResult(self.browse_sdRef)
@@ -579,35 +1488,77 @@ class MDNSListener(Common):
 class Canon6DConnection(Common):
     log_label = 'Canon6DConnection'
 
-    def __init__(self, ip, guid, callback):
+    def __init__(self, ip, guid, callback, ingest_dir=None, ingest_hooks=(),
+                 file_index=False):
         self.ip = ip
         self.guid = guid
         self.callback = callback
+        self.file_index = file_index
+        self.ingest_dir = ingest_dir
+        self.ingest_hooks = ingest_hooks
+        self.log_context = guid
 
     def run(self):
-        self.log('started %s (%s)' % (self.ip, self.guid))
+        self.log('started %s (%s)', self.ip, self.guid)
         self.camera = PTPIPCamera(self.ip, self.guid)
+        index = None
+        if self.file_index or self.ingest_dir:
+            index = CameraFileIndex(self.guid)
+        ingest = None
+        if self.ingest_dir:
+            ingest = IngestPipeline(self.ingest_dir)
+            for hook in self.ingest_hooks:
+                ingest.add_hook(hook)
+            ingest.log_context = self.guid
         try:
             self.camera.connect()
-            self.log('connected to %s (%s)' % (self.ip, self.guid))
+            self.log('connected to %s (%s)', self.ip, self.guid)
+            if index:
+                self.sync_index(index)
+            if ingest:
+                ingest.start()
+                self.camera.ingest = ingest
             self.callback(self.camera)
         except Exception as e:
-            self.log('failed for %s (%s) - %s' % (self.ip, self.guid, str(e)))
+            self.error('failed for %s (%s) - %s', self.ip, self.guid, str(e))
         finally:
+            if ingest and ingest.threads:
+                ingest.shutdown()
+                ingest.join()
+            try:
+                if index:
+                    index.save()
+            except Exception as e:
+                self.error('unable to save file index - %s', str(e))
             try:
                 self.camera.disconnect()
             except:
                 pass
-        self.log('shutdown %s (%s)' % (self.ip, self.guid))
+        self.log('shutdown %s (%s)', self.ip, self.guid)
+
+    def sync_index(self, index):
+        try:
+            index.load()
+            index.sync(self.camera)
+            self.camera.file_index = index
+        except Exception as e:
+            self.log('file index unavailable - %s', str(e))
 
 class Canon6DConnector:
-    def __init__(self, callback):
+    # files downloaded with camera.download() are ingested into ingest_dir;
+    # each hook is called with the record of every ingested file.  The
+    # on-card file index is kept when file_index is set or ingesting.
+    def __init__(self, callback, ingest_dir=None, ingest_hooks=(), file_index=False):
         self.callback = callback
+        self.ingest_dir = ingest_dir
+        self.ingest_hooks = ingest_hooks
+        self.file_index = file_index
         self.connections = []
 
     def connect(self, ip, guid):
         if len(self.connections) == 0:
-            connection = Canon6DConnection(ip, guid, self.callback)
+            connection = Canon6DConnection(ip, guid, self.callback,
+                    self.ingest_dir, self.ingest_hooks, self.file_index)
             connection.start()
             self.connections.append(connection)
 
@@ -616,6 +1567,7 @@ class Canon6DConnector:
             self.connect(ip, guid)
         
         # start up
+        install_excepthook()
         mdns = MDNSListener(callback=callback)
         mdns.start()
 